@@ -0,0 +1,211 @@
+'''
+性能测试，不依赖网络模块，直接运行 python3 bench.py
+'''
+import copy
+import io
+import random
+import tracemalloc
+from contextlib import redirect_stdout
+from time import time
+from lib.account import *
+from lib.chain import *
+from lib.codec import *
+from lib.light import *
+from lib.peer import *
+
+
+def apply_tx(utxo: dict, tx: dict, sign_address):
+    '''
+    模拟 BlockChain.update_utxo，但不做验证
+    '''
+    for source in tx['in']:
+        prev_out = source['prev_out']
+        utxo[prev_out['hash']] = [item for item in utxo[prev_out['hash']] if item['n'] != prev_out['n']]
+        if utxo[prev_out['hash']] == []:
+            utxo.pop(prev_out['hash'])
+    utxo[tx['hash']] = []
+    for destin in tx['out']:
+        utxo[tx['hash']].append({
+            'n': destin['n'],
+            'from': sign_address,
+            'to': destin['recipient'],
+            'value': destin['value'],
+        })
+
+
+def bench_coin_selection(rounds: int = 50, outputs: int = 60, seed: int = 0):
+    '''
+    对每种选币策略，统计每次转账平均使用的输入数量和最终剩余的 utxo 数量
+    策略找不到合适的组合时退回到 largest 并单独计数，使各策略的转账次数相同
+    '''
+    payer = Account('bench_payer')
+    payee = Account('bench_payee')
+    print('coin selection: %d transfers, %d initial outputs' % (rounds, outputs))
+    for strategy in COIN_SELECTORS:
+        rand = random.Random(seed)
+        utxo = {}
+        for i in range(outputs):
+            utxo['coinbase%d' % i] = [{'n': 0, 'from': 0, 'to': payer.get_address(), 'value': rand.randint(1, 20)}]
+        inputs = 0
+        done = 0
+        fallback = 0
+        for _ in range(rounds):
+            amount = rand.randint(1, 12)
+            with redirect_stdout(io.StringIO()):
+                tx = payer.transfer(payee.get_address(), amount, utxo, strategy)
+                if tx is None:
+                    fallback += 1
+                    tx = payer.transfer(payee.get_address(), amount, utxo, 'largest')
+            if tx is None:
+                continue
+            inputs += len(tx['in'])
+            done += 1
+            apply_tx(utxo, tx, payer.get_address())
+        remaining = len(payer.balance_n_records(utxo)[1])
+        print('%-12s avg inputs %.2f  transfers %d  fallbacks %d  remaining outputs %d'
+              % (strategy, inputs / max(done, 1), done, fallback, remaining))
+
+
+def mine_chain(blocks: int, seed: int = 0, payee: str = None):
+    '''
+    挖出一条带有转账的链，供同步相关的测试使用
+    '''
+    rand = random.Random(seed)
+    miner = Account('bench_miner')
+    if payee is None:
+        payee = Account('bench_payee').get_address()
+    bc = BlockChain()
+    for _ in range(blocks):
+        with redirect_stdout(io.StringIO()):
+            tx = miner.transfer(payee, rand.randint(1, 10), bc.utxo)
+        if tx is not None:
+            bc.current_transactions.append(tx)
+        bc.new_block(miner)
+    return bc
+
+
+def bench_chain_sync(blocks: int = 32):
+    '''
+    比较串行与进程池两种方式同步一条链的吞吐量（块/秒）
+    '''
+    bc = mine_chain(blocks)
+    print('chain sync: %d blocks' % blocks)
+    for workers in sorted({1, SYNC_WORKERS}):
+        start = time()
+        utxo = BlockChain().sync_chain(bc.chain, blocks, workers=workers)
+        elapsed = time() - start
+        print('workers %-3d valid %s  %.1f blocks/s' % (workers, utxo is not None, blocks / max(elapsed, 1e-6)))
+
+
+def bench_gossip(sizes=(16, 64, 256, 1024), seed: int = 0):
+    '''
+    在内存中模拟 gossip 转发，统计每个节点平均发送的消息数和覆盖率
+    '''
+    random.seed(seed)
+    print('gossip: fanout and messages sent per node')
+    for size in sizes:
+        addresses = [('127.0.0.1', 10000 + i) for i in range(size)]
+        managers = {address: PeerManager([a for a in addresses if a != address]) for address in addresses}
+        sent = 0
+        reached = set()
+        # (接收方, 来源)
+        queue = [(addresses[0], None)]
+        while queue:
+            address, source = queue.pop()
+            if not managers[address].first_seen('msg'):
+                continue
+            reached.add(address)
+            for peer in managers[address].sample(exclude=source):
+                sent += 1
+                queue.append((peer, address))
+        print('nodes %-5d fanout %-3d sends/node %.2f  reached %.1f%%'
+              % (size, PeerManager.fanout(size - 1), sent / size, 100 * len(reached) / size))
+
+
+def bench_chain_transfer(blocks: int = 32, bad: int = 4):
+    '''
+    比较链报文压缩前后的大小，以及坏块在前面时流式解析读取的块数
+    '''
+    bc = mine_chain(blocks)
+    header = {'type': 'response_chain', 'content': blocks}
+    plain = encode_lines([header] + bc.chain)
+    packed = compress(plain, CODECS)
+    print('chain transfer: %d blocks, plain %d bytes, zlib %d bytes (%.1f%%)'
+          % (blocks, len(plain), len(packed), 100 * len(packed) / len(plain)))
+    chain = copy.deepcopy(bc.chain)
+    chain[bad]['header']['nonce'] += 1
+    packed = compress(encode_lines([header] + chain), CODECS)
+    objects = iter_objects(packed)
+    next(objects)
+    decoded = [0]
+
+    def counted():
+        for block in objects:
+            decoded[0] += 1
+            yield block
+
+    start = time()
+    res = BlockChain().sync_chain(counted(), blocks, workers=1)
+    print('bad block at %d: rejected %s after decoding %d of %d blocks in %.3fs'
+          % (bad, res is None, decoded[0], blocks, time() - start))
+
+
+def bench_pruning(blocks: int = 1000, depth: int = 100):
+    '''
+    比较裁剪模式开关时每 1000 个块占用的内存（tracemalloc 统计）
+    块由少量真实挖出的块复制得到，只用于统计内存，不做验证
+    '''
+    template = mine_chain(8).chain
+    print('pruning: depth %d' % depth)
+    for prune_depth in (None, depth):
+        tracemalloc.start()
+        bc = BlockChain(prune_depth)
+        for i in range(blocks):
+            bc.chain.append(copy.deepcopy(template[i % len(template)]))
+            bc.prune()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('prune %-5s %.1f KiB per 1000 blocks' % (prune_depth, size / 1024 * 1000 / blocks))
+
+
+def bench_light_client(blocks: int = 32):
+    '''
+    比较全节点同步整条链与轻节点同步 header 和钱包相关 tx 的启动时间和流量
+    '''
+    payee = Account('bench_payee').get_address()
+    bc = mine_chain(blocks, payee=payee)
+    print('light client: %d blocks' % blocks)
+
+    start = time()
+    full = encode_lines([{'type': 'response_chain', 'content': blocks}] + bc.chain)
+    objects = iter_objects(full)
+    next(objects)
+    node = BlockChain()
+    node.resolve_conflicts(objects, blocks)
+    print('full   %6d bytes  %.3fs' % (len(full), time() - start))
+
+    start = time()
+    headers = encode_lines([{'type': 'response_headers', 'content': 0}] + [block['header'] for block in bc.chain])
+    proofs = encode_lines([{'type': 'response_proofs', 'content': 0}] + bc.get_proofs(payee))
+    lc = LightChain()
+    objects = iter_objects(headers)
+    next(objects)
+    lc.receive_headers(0, objects)
+    objects = iter_objects(proofs)
+    next(objects)
+    for proof in objects:
+        lc.receive_proof(proof)
+    elapsed = time() - start
+    light = sum(item['value'] for records in lc.utxo(payee).values() for item in records)
+    full = sum(item['value'] for records in node.utxo.values() for item in records if item['to'] == payee)
+    print('light  %6d bytes (headers %d, proofs %d)  %.3fs  %d txs  balance matches %s'
+          % (len(headers) + len(proofs), len(headers), len(proofs), elapsed, len(lc.txs), light == full))
+
+
+if __name__ == '__main__':
+    bench_coin_selection()
+    bench_chain_sync()
+    bench_gossip()
+    bench_chain_transfer()
+    bench_pruning()
+    bench_light_client()
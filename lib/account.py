@@ -4,6 +4,125 @@ from binascii import hexlify, unhexlify
 from time import time
 from lib.crypto import *
 
+# 单笔交易最多使用的输入数量，每个输入都需要一次签名和验证
+MAX_INPUTS = 10
+# 精确匹配搜索的最大尝试次数
+MAX_TRIES = 1000
+
+
+def index_records(records: list) -> dict:
+    '''
+    把未花费记录按金额建立索引，便于查找金额恰好相等的记录
+    :param records: [(hash, n, value)..]
+    :return: {value: [(hash, n, value)..]}
+    '''
+    index = {}
+    for record in records:
+        index.setdefault(record[2], []).append(record)
+    return index
+
+
+def select_exact(records: list, amount: int):
+    '''
+    寻找金额之和恰好等于 amount 的记录组合，这样不会产生找零
+    先查索引找单条记录，再按输入数量从少到多进行有限次数的搜索
+    :param records: [(hash, n, value)..]
+    :param amount: 金额
+    :return: 选中的记录列表 / None
+    '''
+    index = index_records(records)
+    if amount in index:
+        return [index[amount][0]]
+    records = sorted(records, key=lambda r: r[2], reverse=True)
+    # suffix[i] 为 records[i:] 的金额之和，用于剪枝
+    suffix = [0] * (len(records) + 1)
+    for i in range(len(records) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + records[i][2]
+    tries = [0]
+
+    def search(start, remain, depth, chosen):
+        if remain == 0:
+            return list(chosen)
+        if depth == 0 or tries[0] >= MAX_TRIES:
+            return None
+        for i in range(start, len(records)):
+            if suffix[i] < remain:
+                break
+            if records[i][2] > remain:
+                continue
+            tries[0] += 1
+            chosen.append(records[i])
+            res = search(i + 1, remain - records[i][2], depth - 1, chosen)
+            chosen.pop()
+            if res is not None:
+                return res
+        return None
+
+    for depth in range(2, MAX_INPUTS + 1):
+        res = search(0, amount, depth, [])
+        if res is not None:
+            return res
+        if tries[0] >= MAX_TRIES:
+            break
+    return None
+
+
+def select_largest_first(records: list, amount: int):
+    '''
+    从金额最大的记录开始选择，输入数量最少
+    :param records: [(hash, n, value)..]
+    :param amount: 金额
+    :return: 选中的记录列表 / None（MAX_INPUTS 个输入以内凑不够金额）
+    '''
+    pay = 0
+    chosen = []
+    for record in sorted(records, key=lambda r: r[2], reverse=True):
+        if pay >= amount or len(chosen) >= MAX_INPUTS:
+            break
+        pay += record[2]
+        chosen.append(record)
+    if pay < amount:
+        return None
+    return chosen
+
+
+def select_consolidate(records: list, amount: int):
+    '''
+    空闲时使用，先按最大优先凑够金额，再把剩余最小的记录一并花掉并入找零
+    以此减少 utxo 中零碎记录的数量
+    :param records: [(hash, n, value)..]
+    :param amount: 金额
+    :return: 选中的记录列表 / None
+    '''
+    chosen = select_largest_first(records, amount)
+    if chosen is None:
+        return None
+    rest = sorted((r for r in records if r not in chosen), key=lambda r: r[2])
+    for record in rest:
+        if len(chosen) >= MAX_INPUTS:
+            break
+        chosen.append(record)
+    return chosen
+
+
+def select_default(records: list, amount: int):
+    '''
+    优先精确匹配（无找零），否则使用最大优先
+    '''
+    chosen = select_exact(records, amount)
+    if chosen is None:
+        chosen = select_largest_first(records, amount)
+    return chosen
+
+
+# 可选的选币策略
+COIN_SELECTORS = {
+    'default': select_default,
+    'exact': select_exact,
+    'largest': select_largest_first,
+    'consolidate': select_consolidate,
+}
+
 
 class Account:
     def __init__(self, name: str):
@@ -64,34 +183,51 @@ class Account:
     def show_balance(self, utxo):
         print("Balance:", self.balance_n_records(utxo)[0])
 
-    def transfer(self, destin: str, amount: int, utxo: dict):
+    def transfer(self, destin: str, amount: int, utxo: dict, strategy: str = 'default'):
         '''
         转账的对外接口，只需要提供转账的收款方和金额，以及需要更新的utxo
         需要检查 转账金额是否为负（不允许贷款）以及是否有足够多的金额完成转账
         :param destin: 收款方
         :param amount: 金额
         :param utxo:
+        :param strategy: 选币策略，见 COIN_SELECTORS
         :return: None / 待广播的 tx 列表
         '''
         if amount <= 0:
             return None
+        if strategy not in COIN_SELECTORS:
+            print("Unknown coin selection strategy:", strategy)
+            return None
         total, records = self.balance_n_records(utxo)
         if total < amount:
             print("Only remaining:", total)
             return None
-        pay = 0
-        sources = []
-        i = 0
-        while pay < amount:
-            pay += records[i][2]
-            sources.append((records[i][0], records[i][1]))
-            i += 1
+        chosen = COIN_SELECTORS[strategy](records, amount)
+        if chosen is None:
+            print("No suitable outputs for", strategy, "within", MAX_INPUTS, "inputs")
+            return None
+        pay = sum(record[2] for record in chosen)
+        sources = [(record[0], record[1]) for record in chosen]
         if pay == amount:
             destins = [(destin, amount)]
         else:
             destins = [(destin, amount), (self.address, pay - amount)]
         return self.new_transaction(sources, destins)
 
+    def consolidate(self, utxo: dict):
+        '''
+        空闲时把最小的若干条未花费记录合并成一条转给自己
+        :param utxo:
+        :return: None / 待广播的 tx
+        '''
+        total, records = self.balance_n_records(utxo)
+        if len(records) < 2:
+            return None
+        chosen = sorted(records, key=lambda r: r[2])[:MAX_INPUTS]
+        sources = [(record[0], record[1]) for record in chosen]
+        destins = [(self.address, sum(record[2] for record in chosen))]
+        return self.new_transaction(sources, destins)
+
     def new_transaction(self, sources: list, destins: list):
         '''
         transfer 所调用的内部接口，构造生成一个 tx 记录
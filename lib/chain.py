@@ -1,16 +1,161 @@
 import hashlib
 import json
+import multiprocessing
+import os
+import zlib
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from time import time
 from lib.crypto import *
 from lib.account import *
 
+# 同步时用于上下文无关检查的进程数
+SYNC_WORKERS = os.cpu_count() or 1
+# 链长度小于该值时不启用进程池
+PARALLEL_THRESHOLD = 16
+# 裁剪模式下至少保留完整内容的块数
+PRUNE_DEPTH_MIN = 1
+
+
+def tx_checksum(tx: dict) -> str:
+    text = str(tx['timestamp']) + json.dumps(tx['in'], sort_keys=True) + json.dumps(tx['out'], sort_keys=True)
+    return double_sha256(text)
+
+
+def valid_value(value) -> bool:
+    '''
+    金额必须是非负整数（bool 虽然是 int 的子类，也不允许）
+    '''
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def check_tx(tx: dict):
+    '''
+    不依赖 utxo 的 tx 检查：hash 正确，out 字段的格式和金额有效，in 字段的签名能够通过验证
+    :param tx: 待验证的 tx
+    :return: 错误信息 / None
+    '''
+    if tx['hash'] != tx_checksum(tx):
+        return 'tx checksum failed'
+    for j in tx['out']:
+        if not isinstance(j['recipient'], str) or not isinstance(j['n'], int) or not valid_value(j['value']):
+            return 'malformed output'
+    for j in tx['in']:
+        text = json.dumps(j['prev_out'], sort_keys=True)
+        try:
+            if verify_sig(msg=text, signature=j['sig'], pu_s=j['public_key']) is False:
+                return 'sig verification failed'
+        except ecdsa.BadSignatureError:
+            return 'sig verification failed'
+    return None
+
+
+def check_block(block: dict):
+    '''
+    不依赖 utxo 的检查，可以在多个进程中对不同的块并行进行
+    1 符合工作量证明
+    2 hash_merkle_root 和当前的 tx 符合
+    3 每个 tx 的 hash 正确，第一个 tx 没有 in，挖矿酬劳总共不超过20
+    4 in 字段的签名能够通过验证
+    :param block: 待验证的块
+    :return: (错误信息 / None, 块的散列值)
+    '''
+    block_hash = None
+    try:
+        header = block['header']
+        block_hash = hash_header(header)
+        txs = block['tx']
+        if BlockChain.valid_proof(header) is False:
+            return 'valid proof unmatch', block_hash
+        if header['hash_merkle_root'] != get_merkle_tree_root(txs):
+            return 'merkle root unmatch', block_hash
+        if len(txs) != 0:
+            coinbase = txs[0]
+            if coinbase['in'] != []:
+                return 'coinbase has inputs', block_hash
+            if any(not valid_value(j['value']) for j in coinbase['out']):
+                return 'invalid output value', block_hash
+            if sum(j['value'] for j in coinbase['out']) > 20:
+                return 'too much reward', block_hash
+        for tx in txs:
+            error = check_tx(tx)
+            if error is not None:
+                return error, block_hash
+        return None, block_hash
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        return 'malformed block: %r' % e, block_hash
+
+
+def hash_header(header: dict) -> str:
+    '''
+    块的散列值只对 header 计算，tx 由 hash_merkle_root 保证，
+    这样只有 header 也能验证 hash_prev_block
+    :param header: 即区块的header字段
+    :return: 块的散列值
+    '''
+    return double_sha256(json.dumps(header, sort_keys=True))
+
+
+def sync_executor(workers: int):
+    '''
+    main.py 在导入时就会要求输入端口并绑定 socket，
+    spawn 方式启动的子进程会重新执行它，所以只用 fork 方式的进程池，
+    不支持 fork 的系统（如 Windows）退回到线程池
+    :param workers: 进程数
+    :return: executor
+    '''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def check_chain(blocks, workers: int, length: int):
+    '''
+    按顺序产出每个块的检查结果，后面的块在进程池里并行检查
+    blocks 可以是边接收边解析的迭代器，只会提前读取有限个块
+    :param blocks: 待验证的块的迭代器
+    :param workers: 进程数
+    :param length: 块的数量
+    :return: (块, 错误信息 / None, 块的散列值) 的迭代器
+    '''
+    blocks = iter(blocks)
+    if workers <= 1 or length < PARALLEL_THRESHOLD:
+        for block in blocks:
+            yield (block,) + check_block(block)
+        return
+    window = deque()
+    with sync_executor(workers) as executor:
+        for block in blocks:
+            window.append((block, executor.submit(check_block, block)))
+            if len(window) >= workers * 4:
+                block, future = window.popleft()
+                yield (block,) + future.result()
+        while window:
+            block, future = window.popleft()
+            yield (block,) + future.result()
+
 
 class BlockChain:
-    def __init__(self):
+    def __init__(self, prune_depth: int = None):
+        '''
+        :param prune_depth: 裁剪模式下保留完整内容的块数，None 表示不裁剪
+        '''
         self.current_transactions = []
         self.chain = []
+        if prune_depth is not None:
+            prune_depth = max(prune_depth, PRUNE_DEPTH_MIN)
+        self.prune_depth = prune_depth
+        # 高度小于该值的块只保留了 header
+        self.pruned_height = 0
         # a dict, could be indexed faster
         self.utxo = {}
+        # 按收款方索引的 utxo：地址 -> {tx 的 hash: [记录..]}，转账时只需要查看自己的记录
+        self.outputs = {}
+        # 地址 -> [(块高度, tx 的 hash, 方向, 金额)..]，按块高度递增
+        self.history = {}
+        # 每个块涉及的地址，回滚时使用
+        self.history_addresses = []
 
     @staticmethod
     def valid_proof(header: dict) -> bool:
@@ -38,14 +183,19 @@ class BlockChain:
         if len(self.chain) == 0:
             hash_prev_block = 0
         else:
-            hash_prev_block = double_sha256(json.dumps(self.chain[-1], sort_keys=True))
-        # 当前需要记录的 tx
-        txs = self.current_transactions
+            hash_prev_block = hash_header(self.chain[-1]['header'])
         # 报酬，20元
         sources = []
         destins = [(account.get_address(), 20)]
         reward = account.new_transaction(sources, destins)
-        txs.insert(0, reward)
+        # 当前需要记录的 tx，无效的 tx 不会被打包
+        txs = [reward]
+        for tx in self.current_transactions:
+            error = check_tx(tx)
+            if error is None and self.valid_spend(txs + [tx], self.utxo):
+                txs.append(tx)
+            else:
+                print("drop invalid tx", tx['hash'], error or '')
         # 构造初步的header（还需要计算nonce）
         header = {
             'timestamp': time(),
@@ -66,23 +216,28 @@ class BlockChain:
         # Reset the current list of transactions
         self.current_transactions = []
         self.chain.append(block)
+        self.index_block(block)
+        self.prune()
         return block
 
-    def receive_block(self, block: dict):
+    def receive_block(self, block: dict) -> bool:
         '''
         收到其他节点的块，需要进行验证
         然后更新本地相关的数据，如utxo和当前的tx
         :param block: 收到的块，
-        :return: None
+        :return: 是否接收了该块
         '''
-        if self.valid_proof(block['header']) is False:
-            print("receive a false block")
-            return None
+        error, block_hash = check_block(block)
+        if error is not None:
+            print("receive a false block:", error)
+            return False
         if len(self.chain) != 0:
-            if block['header']['hash_prev_block'] != double_sha256(json.dumps(self.chain[-1], sort_keys=True)):
+            if block['header']['hash_prev_block'] != hash_header(self.chain[-1]['header']):
                 print("receive an unmatch block")
-                return None
-        self.update_utxo(block['tx'])
+                return False
+        if self.update_utxo(block['tx']) is False:
+            print("receive a false block")
+            return False
         # current_transaction -= block['tx']
         for tx in block['tx']:
             for ty in self.current_transactions:
@@ -90,72 +245,184 @@ class BlockChain:
                     self.current_transactions.remove(ty)
 
         self.chain.append(block)
+        self.index_block(block)
+        self.prune()
+        return True
 
     def show_chain(self):
         print(json.dumps(self.chain, indent=2, sort_keys=True))
+        if self.pruned_height != 0:
+            print("blocks below height", self.pruned_height, "are pruned, only headers are kept")
+
+    def prune(self):
+        '''
+        裁剪模式下，把深度超过 prune_depth 的块替换为只有 header 的记录
+        utxo 和交易历史索引不受影响
+        :return: None
+        '''
+        if self.prune_depth is None:
+            return
+        while self.pruned_height < len(self.chain) - self.prune_depth:
+            block = self.chain[self.pruned_height]
+            self.chain[self.pruned_height] = {
+                'header': block['header'],
+                'tx_count': len(block['tx']),
+                'pruned': True,
+            }
+            self.pruned_height += 1
 
     def valid_chain(self, chain: list) -> bool:
         '''
-        验证给定的链是否是有效的，从以下几个方面验证
-        1 每一个块的 hash_prev_block 是否和上一个块的散列值相符
-        2 每一个块的 hash_merkle_root 是否和当前的 tx 符合
-        3 符合工作量证明
+        验证给定的链是否是有效的，见 sync_chain
         :param chain: 带验证的链
         :return: 是否有效
         '''
-        current_index = 1
-        while current_index < len(chain):
-            header = chain[current_index]['header']
-            tx = chain[current_index]['tx']
-            # check header hash
-            hash_prev_block = double_sha256(json.dumps(chain[current_index - 1], sort_keys=True))
-            if header['hash_prev_block'] != hash_prev_block:
-                print('previous block unmatch')
-                return False
-            # check merkle root
-            hash_merkle_root = get_merkle_tree_root(tx)
-            if header['hash_merkle_root'] != hash_merkle_root:
-                print('merkle root unmatch')
+        for block in chain:
+            if block.get('pruned'):
+                print("cannot validate a pruned chain")
                 return False
-            # proof of work
-            if self.valid_proof(header) is False:
-                print('valid proof unmatch')
-                return False
-            current_index += 1
-        return True
+        return self.sync_chain(chain, len(chain)) is not None
 
-    def resolve_conflicts(self, new_chain: list):
+    def sync_chain(self, blocks, length: int, genesis: str = None, workers: int = SYNC_WORKERS):
+        '''
+        分阶段验证给定的链，并同时得到对应的 utxo
+        1 上下文无关的检查（工作量证明，merkle 根，tx 的 hash，签名）在进程池中并行
+        2 按顺序检查 hash_prev_block 是否和上一个块的散列值相符，
+          以及 in 是否未花费、是否属于签名者、金额是否足够，并更新 utxo
+        第二阶段跟在第一阶段后面，不需要等所有块都检查完
+        遇到无效的块立即返回，之后的块不会再从 blocks 中读取
+        :param blocks: 待验证的链，或者边接收边解析的块的迭代器
+        :param length: 块的数量
+        :param genesis: 要求的创始区块的散列值，None 表示不检查
+        :param workers: 进程数
+        :return: None / (验证通过的链, 对应的 utxo)
+        '''
+        chain = []
+        utxo = {}
+        prev_hash = None
+        checked = check_chain(blocks, workers, length)
+        while True:
+            index = len(chain)
+            try:
+                block, error, block_hash = next(checked)
+            except StopIteration:
+                break
+            except (zlib.error, ValueError) as e:
+                # 收到的报文无法解压或解析
+                print('cannot decode block', index, e)
+                checked.close()
+                return None
+            if index == 0 and genesis is not None and block_hash != genesis:
+                print("Not a valid chain source")
+                return None
+            if error is not None:
+                print(error, 'at block', index)
+                return None
+            if index != 0 and block['header']['hash_prev_block'] != prev_hash:
+                print('previous block unmatch at block', index)
+                return None
+            if self.valid_spend(block['tx'], utxo) is False:
+                return None
+            self.apply_tx_list(utxo, block['tx'])
+            chain.append(block)
+            prev_hash = block_hash
+        if len(chain) != length:
+            print('chain length unmatch')
+            return None
+        return chain, utxo
+
+    def resolve_conflicts(self, new_chain, length: int = None):
         '''
         根据收到的 new_chain 对本地的链和utxo进行更新
         如果遇到以下情况则不更新
         1 新的链较短
         2 新的链的创始区块和本地的不一致
-        :param new_chain:
+        :param new_chain: 新的链，或者边接收边解析的块的迭代器
+        :param length: 新的链的长度，new_chain 为迭代器时需要提供
         :return:
         '''
-        if len(new_chain) <= len(self.chain):
+        if length is None:
+            length = len(new_chain)
+        if length <= len(self.chain):
             return
-        if self.valid_chain(new_chain) is False:
+        genesis = hash_header(self.chain[0]['header']) if len(self.chain) != 0 else None
+        start = time()
+        res = self.sync_chain(new_chain, length, genesis)
+        if res is None:
             print("false chain")
             return
-        if len(self.chain) != 0 and self.chain[0] != new_chain[0]:
-            print("Not a valid chain source")
-            return
+        new_chain, utxo = res
+        elapsed = time() - start
+        print("synced %d blocks, %.1f blocks/s" % (len(new_chain), len(new_chain) / max(elapsed, 1e-6)))
+        # 只回滚和重建分叉点之后的历史索引
+        fork = 0
+        while fork < len(self.chain) and hash_header(self.chain[fork]['header']) == hash_header(new_chain[fork]['header']):
+            fork += 1
+        while len(self.history_addresses) > fork:
+            self.unindex_block()
         self.chain = new_chain
-        self.utxo = {}
-        for block in self.chain:
-            self.update_utxo(block['tx'])
+        self.utxo = utxo
+        self.outputs = self.index_outputs(utxo)
+        self.pruned_height = 0
+        for block in self.chain[fork:]:
+            self.index_block(block)
+        self.prune()
 
-    def update_utxo(self, tx_list: list):
+    def update_utxo(self, tx_list: list) -> bool:
         '''
         每收到一个新的块，则对utxo进行更新（包括自己挖矿和收到其他节点的广播）
         把每个tx中消费的记录删除，并且把out中的记录添加到utxo里面
+        和 sync_chain 使用同样的 valid_spend 检查，签名等由调用方检查
         :param tx_list: 块的 tx 字段
-        :return: None
+        :return: 是否验证通过并更新
         '''
-        if self.valid_tx_list(tx_list) is False:
+        if self.valid_spend(tx_list, self.utxo) is False:
             print("UTXO: valid tx list failed")
+            return False
+        self.apply_tx_list(self.utxo, tx_list, self.outputs)
+        return True
+
+    def utxo_of(self, address: str) -> dict:
+        '''
+        某个地址的 utxo，格式和 utxo 相同，可以直接用于 Account.transfer
+        :param address: 地址
+        :return: 该地址的 utxo
+        '''
+        return dict(self.outputs.get(address, {}))
+
+    @staticmethod
+    def index_outputs(utxo: dict) -> dict:
+        '''
+        根据 utxo 重新建立按收款方的索引
+        :param utxo:
+        :return: 地址 -> {tx 的 hash: [记录..]}
+        '''
+        outputs = {}
+        for hash in utxo:
+            for item in utxo[hash]:
+                outputs.setdefault(item['to'], {}).setdefault(hash, []).append(item)
+        return outputs
+
+    @staticmethod
+    def remove_output(outputs: dict, item: dict, hash: str):
+        own = outputs.get(item['to'], {})
+        if hash not in own:
             return
+        own[hash] = [record for record in own[hash] if record['n'] != item['n']]
+        if own[hash] == []:
+            own.pop(hash)
+        if own == {}:
+            outputs.pop(item['to'])
+
+    @staticmethod
+    def apply_tx_list(utxo: dict, tx_list: list, outputs: dict = None):
+        '''
+        把已经验证过的 tx 应用到给定的 utxo 上
+        :param utxo: 需要更新的 utxo
+        :param tx_list: 块的 tx 字段
+        :param outputs: 需要同时更新的按收款方的索引，None 表示没有
+        :return: None
+        '''
         for tx in tx_list:
             if len(tx['in']) == 0:
                 sign_address = 0
@@ -163,9 +430,19 @@ class BlockChain:
                 sign_address = get_address(tx['in'][0]['public_key'])
             # 把已经支付的从utxo中删除
             for source in tx['in']:
-                self.remove_utxo(source['prev_out']['hash'], source['prev_out']['n'])
+                hash = source['prev_out']['hash']
+                if hash not in utxo:
+                    continue
+                if outputs is not None:
+                    for item in utxo[hash]:
+                        if item['n'] == source['prev_out']['n']:
+                            BlockChain.remove_output(outputs, item, hash)
+                utxo[hash] = [item for item in utxo[hash] if item['n'] != source['prev_out']['n']]
+                # 整个 hash 值对应的 tx 都已经使用完了
+                if utxo[hash] == []:
+                    utxo.pop(hash)
             # 把未花费的添加到utxo里，这里根据n的数量，应该是一个列表
-            self.utxo[tx['hash']] = []
+            utxo[tx['hash']] = []
             n = 0
             for destin in tx['out']:
                 record = {
@@ -175,7 +452,50 @@ class BlockChain:
                     'value': destin['value'],
                 }
                 n += 1
-                self.utxo[tx['hash']].append(record)
+                utxo[tx['hash']].append(record)
+                if outputs is not None:
+                    outputs.setdefault(record['to'], {}).setdefault(tx['hash'], []).append(record)
+
+    @staticmethod
+    def valid_spend(tx_list: list, utxo: dict) -> bool:
+        '''
+        依赖 utxo 的检查：in 是否未花费，是否属于签名者，总的 in 的金额不少于 out 的金额
+        同一个块内（包括同一个 tx 内）的 in 不能重复花费同一笔记录
+        签名等上下文无关的检查由 check_block 完成
+        :param tx_list: 块的 tx 字段
+        :param utxo: 该块之前的 utxo
+        :return: 是否满足要求
+        '''
+        spent = set()
+        for tx in tx_list[1:]:
+            input_sum = 0
+            output_sum = 0
+            for j in tx['in']:
+                prev_out = j['prev_out']
+                if (prev_out['hash'], prev_out['n']) in spent:
+                    print("input spent twice in a block")
+                    return False
+                spent.add((prev_out['hash'], prev_out['n']))
+                record = None
+                for item in utxo.get(prev_out['hash'], []):
+                    if item['n'] == prev_out['n']:
+                        record = item
+                if record is None:
+                    print("input already spent or unknown")
+                    return False
+                if get_address(j['public_key']) != record['to']:
+                    print("recipient unmatch")
+                    return False
+                input_sum += record['value']
+            for j in tx['out']:
+                if not valid_value(j['value']):
+                    print("invalid output value")
+                    return False
+                output_sum += j['value']
+            if input_sum < output_sum:
+                print('input cannot cover output')
+                return False
+        return True
 
     def remove_utxo(self, hash: str, n: int):
         '''
@@ -189,75 +509,153 @@ class BlockChain:
             return
         for item in self.utxo[hash]:
             if item['n'] == n:
+                self.remove_output(self.outputs, item, hash)
                 self.utxo[hash].remove(item)
                 # 整个 hash 值对应的 tx 都已经使用完了
                 if self.utxo[hash] == []:
                     self.utxo.pop(hash)
 
+    def index_block(self, block: dict):
+        '''
+        把新加入链的块记录到地址的交易历史中
+        方向：in 收款，out 付款（金额不含找零），self 转给自己
+        :param block: 刚加入链的块
+        :return: None
+        '''
+        height = len(self.history_addresses)
+        addresses = set()
+        for tx in block['tx']:
+            entries = {}
+            if len(tx['in']) == 0:
+                sign_address = None
+            else:
+                sign_address = get_address(tx['in'][0]['public_key'])
+            for destin in tx['out']:
+                if destin['recipient'] == sign_address:
+                    continue
+                entries[destin['recipient']] = entries.get(destin['recipient'], 0) + destin['value']
+            if sign_address is not None:
+                sent = sum(entries.values())
+                if sent == 0:
+                    value = sum(destin['value'] for destin in tx['out'])
+                    self.history.setdefault(sign_address, []).append((height, tx['hash'], 'self', value))
+                else:
+                    self.history.setdefault(sign_address, []).append((height, tx['hash'], 'out', sent))
+                addresses.add(sign_address)
+            for address, value in entries.items():
+                self.history.setdefault(address, []).append((height, tx['hash'], 'in', value))
+                addresses.add(address)
+        self.history_addresses.append(addresses)
+
+    def unindex_block(self):
+        '''
+        回滚最后一个块的交易历史
+        :return: None
+        '''
+        height = len(self.history_addresses) - 1
+        for address in self.history_addresses.pop():
+            entries = self.history[address]
+            while len(entries) != 0 and entries[-1][0] == height:
+                entries.pop()
+            if len(entries) == 0:
+                self.history.pop(address)
+
+    def get_history(self, address: str, page: int = 0, size: int = 10) -> list:
+        '''
+        分页查询某个地址的交易历史，最新的在前
+        :param address: 地址
+        :param page: 页码，从 0 开始
+        :param size: 每页的数量
+        :return: [(块高度, tx 的 hash, 方向, 金额)..]
+        '''
+        entries = self.history.get(address, [])
+        end = len(entries) - page * size
+        if page < 0 or size <= 0 or end <= 0:
+            return []
+        return entries[max(end - size, 0):end][::-1]
+
+    def get_proofs(self, address: str, start: int = 0) -> list:
+        '''
+        给轻节点提供某个地址从 start 高度开始的 tx 及其 merkle 路径
+        被裁剪的块无法提供
+        :param address: 地址
+        :param start: 起始的块高度
+        :return: [{"height": 块高度, "index": tx 在块中的位置, "tx": tx, "branch": merkle 路径}..]
+        '''
+        entries = self.history.get(address, [])
+        proofs = []
+        seen = set()
+        for height, tx_hash, direction, value in entries[bisect_left(entries, (start,)):]:
+            if tx_hash in seen:
+                continue
+            seen.add(tx_hash)
+            if height < self.pruned_height:
+                print("block", height, "is pruned, cannot provide proof")
+                continue
+            txs = self.chain[height]['tx']
+            for index in range(len(txs)):
+                if txs[index]['hash'] == tx_hash:
+                    proofs.append({
+                        'height': height,
+                        'index': index,
+                        'tx': txs[index],
+                        'branch': get_merkle_branch(txs, index),
+                    })
+        return proofs
+
+    def show_history(self, address: str, page: int = 0, size: int = 10):
+        total = len(self.history.get(address, []))
+        print("address:", address, "records:", total, "page:", page)
+        for height, tx_hash, direction, value in self.get_history(address, page, size):
+            print(height, tx_hash, direction, value)
+
     def show_utxo(self):
         print(json.dumps(self.utxo, indent=2, sort_keys=True))
 
-    def receive_tx(self, tx: dict):
-        if tx is None:
-            return
+    def receive_tx(self, tx: dict) -> bool:
+        '''
+        收到其他节点的 tx，验证签名、是否可以花费以及是否和当前的 tx 冲突
+        :param tx: 收到的 tx
+        :return: 是否加入了当前的 tx
+        '''
+        try:
+            error = check_tx(tx)
+            pending = {(j['prev_out']['hash'], j['prev_out']['n'])
+                       for ty in self.current_transactions for j in ty['in']}
+            if error is None and any((j['prev_out']['hash'], j['prev_out']['n']) in pending for j in tx['in']):
+                error = 'input spent by a current tx'
+            if error is None and not self.valid_spend([None, tx], self.utxo):
+                error = 'cannot spend the inputs'
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            error = 'malformed tx: %r' % e
+        if error is not None:
+            print("receive a false tx:", error)
+            return False
         self.current_transactions.append(tx)
+        return True
 
     def show_tx(self):
         print(json.dumps(self.current_transactions, indent=2, sort_keys=True))
 
-    def valid_tx_list(self, tx_list: list) -> bool:
+    def get_out(self, hash: str, n: int):
         '''
-        对区块的 tx 字段进行校验
-        对第一个tx，需要满足 完整性的验证 和 挖矿酬劳不超过20
-        对其他的tx，需要满足 完整性的验证，in 字段签名能够通过验证，签名和来源一致，总的 in 的金额不少于 out 的金额
-        :param tx_list: 区块的 tx 字段
-        :return: 是否满足要求
+        查询某笔 out 交易的记录，先查 utxo，再查没有被裁剪的块
+        :param hash:
+        :param n:
+        :return: (收款方, 金额) / None
         '''
-        if len(tx_list) == 0:
-            return True
-        # check the first tx
-        checksum = tx_list[0]['hash']
-        timestamp = tx_list[0]['timestamp']
-        tx_input = tx_list[0]['in']
-        tx_output = tx_list[0]['out']
-        if tx_output[0]['value'] > 20:
-            print('too much reward')
-            return False
-        text = str(timestamp) + json.dumps(tx_input, sort_keys=True) + json.dumps(tx_output, sort_keys=True)
-        if checksum != double_sha256(text):
-            print('tx checksum failed')
-            return False
-        # check following
-        for i in range(1, len(tx_list)):
-            checksum = tx_list[i]['hash']
-            timestamp = tx_list[i]['timestamp']
-            tx_input = tx_list[i]['in']
-            tx_output = tx_list[i]['out']
-            input_sum = 0
-            output_sum = 0
-            text = str(timestamp) + json.dumps(tx_input, sort_keys=True) + json.dumps(tx_output, sort_keys=True)
-            if checksum != double_sha256(text):
-                print('tx checksum failed')
-                return False
-            for j in tx_input:
-                prev_out = j['prev_out']
-                text = json.dumps(prev_out, sort_keys=True)
-                input_sum += self.get_out_value(prev_out['hash'], prev_out['n'])
-                # 是否拥有这笔钱
-                if get_address(j['public_key']) != self.get_out_recipient(prev_out['hash'], prev_out['n']):
-                    print("recipient unmatch")
-                    return False
-                # 验证签名
-                if verify_sig(msg=text, signature=j['sig'], pu_s=j['public_key']) is False:
-                    print('sig verification failed')
-                    return False
-            for j in tx_output:
-                output_sum += j['value']
-            # 验证数量
-            if input_sum < output_sum:
-                print('input cannot cover output')
-                return False
-        return True
+        for item in self.utxo.get(hash, []):
+            if item['n'] == n:
+                return item['to'], item['value']
+        for block in self.chain[self.pruned_height:]:
+            for tx in block['tx']:
+                if tx['hash'] == hash:
+                    for out in tx['out']:
+                        if out['n'] == n:
+                            return out['recipient'], out['value']
+        if self.pruned_height != 0:
+            print("out", hash, n, "is spent or in a pruned block")
+        return None
 
     def get_out_value(self, hash: str, n: int):
         '''
@@ -266,25 +664,19 @@ class BlockChain:
         :param n:
         :return:
         '''
-        for block in self.chain:
-            for tx in block['tx']:
-                if tx['hash'] == hash:
-                    for out in tx['out']:
-                        if out['n'] == n:
-                            return out['value']
-        return 0
+        out = self.get_out(hash, n)
+        if out is None:
+            return 0
+        return out[1]
 
     def get_out_recipient(self, hash: str, n: int):
         '''
-        查询某笔 out 交易的额度是多少
+        查询某笔 out 交易的收款方是谁
         :param hash:
         :param n:
         :return:
         '''
-        for block in self.chain:
-            for tx in block['tx']:
-                if tx['hash'] == hash:
-                    for out in tx['out']:
-                        if out['n'] == n:
-                            return out['recipient']
-        return 0
+        out = self.get_out(hash, n)
+        if out is None:
+            return 0
+        return out[0]
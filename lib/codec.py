@@ -0,0 +1,75 @@
+import json
+import zlib
+
+# 本节点支持的压缩方式，通过 ping / pong 与其他节点协商
+CODECS = ['zlib']
+# 压缩报文的首字节，未压缩的报文以 '{' 开头
+COMPRESSED = b'Z'
+# 小于该长度的报文不压缩
+COMPRESS_MIN = 256
+# 流式解压时每次输出的最大字节数
+CHUNK_SIZE = 1024
+# 解压后的最大长度，避免很小的压缩报文解压出大量数据
+MAX_DECOMPRESSED = 1 << 20
+
+
+def encode_lines(objects: list) -> bytes:
+    '''
+    每个对象编码为一行 json，这样接收方可以逐行解析
+    :param objects: 待编码的对象，第一个为报文头
+    :return: 编码后的报文
+    '''
+    return b'\n'.join(json.dumps(obj, sort_keys=True).encode('utf-8') for obj in objects)
+
+
+def compress(data: bytes, codecs: list) -> bytes:
+    '''
+    对方支持 zlib 且报文足够长时进行压缩
+    :param data: 报文
+    :param codecs: 对方支持的压缩方式
+    :return: 压缩后的报文
+    '''
+    if 'zlib' not in codecs or len(data) < COMPRESS_MIN:
+        return data
+    return COMPRESSED + zlib.compress(data)
+
+
+def iter_chunks(buffer: bytes):
+    '''
+    分块解压报文，解压后的总长度超过 MAX_DECOMPRESSED 时抛出 zlib.error
+    :param buffer: 收到的报文
+    :return: 解压后的数据块的迭代器
+    '''
+    if buffer[:1] != COMPRESSED:
+        yield buffer
+        return
+    decompressor = zlib.decompressobj()
+    data = buffer[1:]
+    total = 0
+    while True:
+        chunk = decompressor.decompress(data, CHUNK_SIZE)
+        data = decompressor.unconsumed_tail
+        if chunk == b'' and data == b'':
+            break
+        total += len(chunk)
+        if total > MAX_DECOMPRESSED:
+            raise zlib.error('decompressed message is too large')
+        yield chunk
+
+
+def iter_objects(buffer: bytes):
+    '''
+    流式地解压并逐行解析报文，调用方停止迭代后剩余的部分不会再被解压和解析
+    :param buffer: 收到的报文
+    :return: 对象的迭代器
+    '''
+    pending = b''
+    for chunk in iter_chunks(buffer):
+        pending += chunk
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line != b'':
+                yield json.loads(line.decode('utf-8'))
+    if pending != b'':
+        yield json.loads(pending.decode('utf-8'))
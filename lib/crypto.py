@@ -93,6 +93,52 @@ def get_tree_neighbor_indexes(index: int, size: int) -> list:
     return res
 
 
+def get_merkle_branch(txs: list, index: int) -> list:
+    '''
+    计算第 index 个 tx 到 merkle 树根结点路径上的兄弟结点
+    :param txs: 区块的 tx 字段
+    :param index: tx 在区块中的位置
+    :return: [(兄弟结点的值 / None, 兄弟结点是否在左边)..]，None 表示该层没有兄弟结点
+    '''
+    levels = [[tx['hash'] for tx in txs]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        temp = []
+        for i in range(0, len(level) - 1, 2):
+            temp.append(double_sha256(level[i] + level[i + 1]))
+        if len(level) % 2 == 1:
+            temp.append(double_sha256(level[-1]))
+        levels.append(temp)
+    branch = []
+    for level, neighbor in get_tree_neighbor_indexes(index, len(txs)):
+        if neighbor < len(levels[level]):
+            branch.append((levels[level][neighbor], neighbor < index >> level))
+        else:
+            branch.append((None, False))
+    return branch
+
+
+def verify_merkle_branch(tx_hash: str, branch: list, root: str) -> bool:
+    '''
+    根据 get_merkle_branch 给出的路径验证某个 tx 是否在区块中
+    :param tx_hash: tx 的 hash 值
+    :param branch: get_merkle_branch 的结果
+    :param root: 区块 header 中的 hash_merkle_root
+    :return: 是否验证成功
+    '''
+    if len(branch) == 0:
+        return double_sha256(tx_hash) == root
+    h = tx_hash
+    for neighbor, left in branch:
+        if neighbor is None:
+            h = double_sha256(h)
+        elif left:
+            h = double_sha256(neighbor + h)
+        else:
+            h = double_sha256(h + neighbor)
+    return h == root
+
+
 def verify_sig(msg: str, signature: str, pu_s: str) -> bool:
     '''
     验证签名，消息，签名和公钥都以字符串的形式提供
@@ -0,0 +1,156 @@
+import json
+import zlib
+from lib.crypto import *
+from lib.chain import BlockChain, hash_header, tx_checksum
+
+# 同步 header 时向前多请求的块数，用于发现分叉
+LIGHT_LOOKBACK = 6
+
+
+class LightChain:
+    '''
+    轻节点只同步 header，通过 valid_proof 和 hash_prev_block 验证
+    与钱包有关的 tx 由全节点附带 merkle 路径发送，对照 hash_merkle_root 验证
+    全节点可以隐瞒某些 tx，但不能伪造
+    '''
+    def __init__(self):
+        self.headers = []
+        self.hashes = []
+        # tx 的 hash -> (块高度, tx 在块中的位置, tx)
+        self.txs = {}
+        # 上次请求 proof 时的 header 高度
+        self.proof_height = 0
+
+    def lookback(self) -> int:
+        '''
+        :return: 请求 header 的起始高度
+        '''
+        return max(0, len(self.headers) - LIGHT_LOOKBACK)
+
+    def proof_start(self) -> int:
+        '''
+        请求 proof 的起始高度，只请求上次请求之后的块（再往前 LIGHT_LOOKBACK 个）
+        :return: 起始高度
+        '''
+        start = max(0, self.proof_height - LIGHT_LOOKBACK)
+        self.proof_height = len(self.headers)
+        return start
+
+    def receive_headers(self, start: int, headers) -> bool:
+        '''
+        收到从 start 开始的 header，验证后如果比本地的更长则替换
+        :param start: 第一个 header 的高度
+        :param headers: header 的列表，或者边接收边解析的迭代器
+        :return: 是否更新了本地的 header
+        '''
+        if start < 0 or start > len(self.headers):
+            print("headers gap, expect height", len(self.headers))
+            return False
+        new_headers = self.headers[:start]
+        new_hashes = self.hashes[:start]
+        headers = iter(headers)
+        while True:
+            height = len(new_headers)
+            try:
+                header = next(headers)
+            except StopIteration:
+                break
+            except (zlib.error, ValueError) as e:
+                print('cannot decode header', height, e)
+                return False
+            try:
+                if BlockChain.valid_proof(header) is False:
+                    print('valid proof unmatch at header', height)
+                    return False
+            except (KeyError, TypeError) as e:
+                print('malformed header', height, e)
+                return False
+            if height != 0 and header['hash_prev_block'] != new_hashes[-1]:
+                print('previous block unmatch at header', height)
+                return False
+            block_hash = hash_header(header)
+            if height == 0 and len(self.hashes) != 0 and block_hash != self.hashes[0]:
+                print("Not a valid chain source")
+                return False
+            new_headers.append(header)
+            new_hashes.append(block_hash)
+        if len(new_headers) <= len(self.headers):
+            return False
+        # 分叉点之后的 tx 需要重新获取
+        fork = start
+        while fork < len(self.hashes) and self.hashes[fork] == new_hashes[fork]:
+            fork += 1
+        for tx_hash in [h for h, item in self.txs.items() if item[0] >= fork]:
+            self.txs.pop(tx_hash)
+        self.proof_height = min(self.proof_height, fork)
+        self.headers = new_headers
+        self.hashes = new_hashes
+        return True
+
+    def receive_proof(self, proof: dict) -> bool:
+        '''
+        验证全节点发来的 tx 及其 merkle 路径
+        :param proof: {"height": 块高度, "index": tx 在块中的位置, "tx": tx, "branch": get_merkle_branch 的结果}
+        :return: 是否验证成功
+        '''
+        if not isinstance(proof, dict) or not isinstance(proof.get('height'), int) \
+                or not isinstance(proof.get('index'), int) or not isinstance(proof.get('tx'), dict) \
+                or not isinstance(proof.get('branch'), list):
+            print('malformed proof')
+            return False
+        height = proof['height']
+        tx = proof['tx']
+        if height < 0 or height >= len(self.headers):
+            print("proof for unknown height", height)
+            return False
+        if not isinstance(tx.get('in'), list) or not isinstance(tx.get('out'), list):
+            print('malformed proof')
+            return False
+        try:
+            if tx['hash'] != tx_checksum(tx):
+                print('tx checksum failed')
+                return False
+            if verify_merkle_branch(tx['hash'], proof['branch'], self.headers[height]['hash_merkle_root']) is False:
+                print('merkle branch unmatch')
+                return False
+        except (KeyError, TypeError, ValueError) as e:
+            print('malformed proof', e)
+            return False
+        self.txs[tx['hash']] = (height, proof['index'], tx)
+        return True
+
+    def utxo(self, address: str) -> dict:
+        '''
+        根据已经验证的 tx 计算某个地址的 utxo，格式和 BlockChain.utxo 相同
+        :param address: 钱包的地址
+        :return: utxo
+        '''
+        utxo = {}
+        for height, index, tx in sorted(self.txs.values(), key=lambda item: item[:2]):
+            if len(tx['in']) == 0:
+                sign_address = 0
+            else:
+                sign_address = get_address(tx['in'][0]['public_key'])
+            for source in tx['in']:
+                hash = source['prev_out']['hash']
+                if hash not in utxo:
+                    continue
+                utxo[hash] = [item for item in utxo[hash] if item['n'] != source['prev_out']['n']]
+                if utxo[hash] == []:
+                    utxo.pop(hash)
+            records = []
+            for destin in tx['out']:
+                if destin['recipient'] == address:
+                    records.append({
+                        'n': destin['n'],
+                        'from': sign_address,
+                        'to': destin['recipient'],
+                        'value': destin['value'],
+                    })
+            if len(records) != 0:
+                utxo[tx['hash']] = records
+        return utxo
+
+    def show_headers(self):
+        print(json.dumps(self.headers, indent=2, sort_keys=True))
+        print("headers:", len(self.headers), "verified txs:", len(self.txs))
@@ -1,7 +1,16 @@
+import hashlib
+import json
+import math
 from socket import *
+from time import time
+from lib.codec import *
+from lib.peer import *
 
 HOST = '127.0.0.1'
-BUF_SIZE = 4096
+# 整条链以一个报文发送，使用 UDP 报文的最大长度
+BUF_SIZE = 65535
+# 单个 UDP 报文能携带的最大数据量
+MAX_DATAGRAM = 65507
 
 PORT = input('Port:')
 LOOP = (HOST, int(PORT))
@@ -10,26 +19,117 @@ NODES = [('127.0.0.1', 8000), ('127.0.0.1', 8001), ('127.0.0.1', 8002),
          ('127.0.0.1', 8003), ('127.0.0.1', 8004), ('127.0.0.1', 8005)]
 if LOOP in NODES:
     NODES.remove(LOOP)
+PEERS = PeerManager(NODES)
 
 SOCKET = socket(AF_INET, SOCK_DGRAM)
 SOCKET.bind(LOOP)
 
 
 def send_msg(msg, address):
+    '''
+    发送报文，对方支持时进行压缩
+    :param msg: 字符串或已经编码的报文
+    :param address: 接收方
+    :return: 是否发送成功
+    '''
+    if isinstance(msg, str):
+        msg = msg.encode('utf-8')
+    msg = compress(msg, PEERS.codecs(address))
+    if len(msg) > MAX_DATAGRAM:
+        print("message of", len(msg), "bytes is too long to send to", address)
+        return False
     try:
-        SOCKET.sendto(msg.encode('utf-8'), address)
-    except ConnectionResetError as e:
+        SOCKET.sendto(msg, address)
+    except (ConnectionResetError, ConnectionRefusedError) as e:
         print(e, address, " is not reachable")
-        NODES.remove(address)
+        PEERS.failure(address)
+        return False
+    except OSError as e:
+        print(e, "when sending", len(msg), "bytes to", address)
+        return False
+    return True
 
 
 def broadcast(msg):
-    for address in NODES:
+    '''
+    发给所有可用的节点，用于请求链等不需要转发的消息
+    '''
+    for address in PEERS.active():
         send_msg(msg, address)
 
 
+def first_seen(msg) -> bool:
+    '''
+    :param msg: 报文
+    :return: 是否是第一次见到这条消息
+    '''
+    return PEERS.first_seen(hashlib.sha256(msg.encode('utf-8')).hexdigest())
+
+
+def relay(msg, source=None):
+    '''
+    把 tx 和块转发给随机选出的有限个全节点，收到的节点会继续转发
+    :param msg: 报文
+    :param source: 消息的来源，不再发回去
+    :return: None
+    '''
+    for address in PEERS.sample(exclude=source):
+        send_msg(msg, address)
+
+
+def gossip(msg, source=None):
+    '''
+    同一条消息只转发一次
+    :param msg: 报文
+    :param source: 消息的来源，不再发回去
+    :return: 是否是第一次见到这条消息
+    '''
+    if not first_seen(msg):
+        return False
+    relay(msg, source)
+    return True
+
+
+def announce_header(index: int, header: dict):
+    '''
+    轻节点不参与块的转发，新块的 header 直接发给它们
+    :param index: 块的高度
+    :param header: 块的 header
+    :return: None
+    '''
+    msg = {"type": "broadcast_header",
+           "index": index,
+           "content": header,
+           }
+    for address in PEERS.light_peers():
+        send_msg(json.dumps(msg, sort_keys=True), address)
+
+
+def valid_ping(content) -> bool:
+    '''
+    ping / pong 的内容：{"time": ping 发出的时间, "codecs": 支持的压缩方式, "light": 是否为轻节点}
+    '''
+    if not isinstance(content, dict):
+        return False
+    sent_at = content.get('time')
+    if not isinstance(sent_at, (int, float)) or isinstance(sent_at, bool) or not math.isfinite(sent_at):
+        return False
+    return isinstance(content.get('codecs', []), list) and isinstance(content.get('light', False), bool)
+
+
+def ping_peers(light: bool = False):
+    '''
+    定期 ping 长时间没有消息的节点，以及退避期已过需要重连的节点
+    :param light: 本节点是否为轻节点，轻节点不会收到转发的 tx 和块
+    '''
+    for address in PEERS.due():
+        msg = {"type": "ping",
+               "content": {"time": time(), "codecs": CODECS, "light": light},
+               }
+        send_msg(json.dumps(msg, sort_keys=True), address)
+
+
 def nodes():
-    global NODES
     nodes_help_info = '1 View Current Nodes\n' \
                       '2 Add New Nodes\n' \
                       '3 Remove Nodes'
@@ -37,28 +137,31 @@ def nodes():
     while True:
         opt = input('>')
         if opt == '1':
-            for addr in NODES:
-                print(addr)
+            PEERS.show()
             return
         elif opt == '2':
             print("Adding broadcasting nodes")
             addr = input('Input address:')
             port = input('Input port:')
-            new_node = (addr, port)
-            if new_node in NODES:
+            if not port.isdigit():
+                print("Invalid port")
+                return
+            new_node = (addr, int(port))
+            if not PEERS.add(new_node):
                 print(new_node, 'was in the nodes list before')
                 return
-            NODES.append(new_node)
             print(new_node, 'is in the nodes list now')
             return
         elif opt == '3':
             print("Removing broadcasting nodes")
             addr = input('Input address:')
             port = input('Input port:')
-            new_node = (addr, port)
-            if new_node in NODES:
+            if not port.isdigit():
+                print("Invalid port")
+                return
+            new_node = (addr, int(port))
+            if PEERS.remove(new_node):
                 print(new_node, 'was removed from the nodes list')
-                NODES.remove(new_node)
                 return
             print(new_node, 'was not in the nodes list')
             return
@@ -0,0 +1,231 @@
+import random
+from collections import OrderedDict
+from math import ceil, log2
+from threading import Lock
+from time import time
+
+# 每次转发的最少节点数
+FANOUT_MIN = 2
+# 重连退避的初始时间和最大时间（秒）
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# ping 的间隔和超时（秒）
+PING_INTERVAL = 10.0
+PING_TIMEOUT = 3.0
+# 记住已经转发过的消息数量
+SEEN_SIZE = 4096
+
+
+class PeerManager:
+    '''
+    维护通信节点的健康状况：延迟、失败次数、最后一次收到消息的时间
+    失败的节点按指数退避后重新尝试，而不是直接删除
+    '''
+    def __init__(self, addresses: list = ()):
+        self.lock = Lock()
+        # (host, port) -> 节点状态
+        self.peers = {}
+        # 已经处理过的消息 id，避免重复转发
+        self.seen = OrderedDict()
+        for address in addresses:
+            self.add(address)
+
+    @staticmethod
+    def normalize(address) -> tuple:
+        return address[0], int(address[1])
+
+    def add(self, address) -> bool:
+        address = self.normalize(address)
+        with self.lock:
+            if address in self.peers:
+                return False
+            self.peers[address] = {
+                'latency': None,
+                'failures': 0,
+                'last_seen': None,
+                'retry_at': 0.0,
+                'ping_at': None,
+                'codecs': [],
+                # 轻节点只接收 header，不参与 tx 和块的转发
+                'light': False,
+            }
+            return True
+
+    def remove(self, address) -> bool:
+        address = self.normalize(address)
+        with self.lock:
+            return self.peers.pop(address, None) is not None
+
+    def __contains__(self, address):
+        return self.normalize(address) in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+
+    def seen_from(self, address):
+        '''
+        收到某个节点的消息，说明它是可达的；未知的节点会被加入列表
+        '''
+        self.add(address)
+        address = self.normalize(address)
+        with self.lock:
+            peer = self.peers[address]
+            peer['last_seen'] = time()
+            peer['failures'] = 0
+            peer['retry_at'] = 0.0
+
+    def set_codecs(self, address, codecs: list):
+        '''
+        记录对方在 ping / pong 中声明支持的压缩方式
+        '''
+        self.seen_from(address)
+        with self.lock:
+            self.peers[self.normalize(address)]['codecs'] = list(codecs)
+
+    def set_light(self, address, light: bool):
+        '''
+        记录对方在 ping / pong 中声明的是否为轻节点
+        '''
+        self.seen_from(address)
+        with self.lock:
+            self.peers[self.normalize(address)]['light'] = light is True
+
+    def codecs(self, address) -> list:
+        peer = self.peers.get(self.normalize(address))
+        if peer is None:
+            return []
+        return peer['codecs']
+
+    def pong(self, address, sent_at: float, codecs: list = (), light: bool = False):
+        '''
+        收到 pong，根据 ping 发出的时间更新延迟（指数滑动平均）
+        '''
+        self.set_codecs(address, codecs)
+        self.set_light(address, light)
+        with self.lock:
+            peer = self.peers[self.normalize(address)]
+            rtt = max(time() - sent_at, 0.0)
+            if peer['latency'] is None:
+                peer['latency'] = rtt
+            else:
+                peer['latency'] = 0.8 * peer['latency'] + 0.2 * rtt
+            peer['ping_at'] = None
+
+    def failure(self, address):
+        '''
+        发送失败或 ping 超时，按失败次数指数退避
+        '''
+        address = self.normalize(address)
+        with self.lock:
+            peer = self.peers.get(address)
+            if peer is None:
+                return
+            peer['failures'] += 1
+            peer['ping_at'] = None
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (peer['failures'] - 1))
+            peer['retry_at'] = time() + backoff
+
+    def active(self) -> list:
+        '''
+        :return: 不在退避期内的节点
+        '''
+        now = time()
+        with self.lock:
+            return [address for address, peer in self.peers.items() if peer['retry_at'] <= now]
+
+    def light_peers(self) -> list:
+        '''
+        :return: 不在退避期内的轻节点，新块只向它们发送 header
+        '''
+        now = time()
+        with self.lock:
+            return [address for address, peer in self.peers.items()
+                    if peer['light'] and peer['retry_at'] <= now]
+
+    def due(self) -> list:
+        '''
+        定期调用：把 ping 超时的节点记为失败，返回需要 ping 的节点
+        包括退避期已过、需要重新连接的节点
+        :return: 需要 ping 的节点
+        '''
+        now = time()
+        timeout = []
+        with self.lock:
+            for address, peer in self.peers.items():
+                if peer['ping_at'] is not None and now - peer['ping_at'] > PING_TIMEOUT:
+                    timeout.append(address)
+        for address in timeout:
+            self.failure(address)
+        res = []
+        with self.lock:
+            for address, peer in self.peers.items():
+                if peer['ping_at'] is not None or peer['retry_at'] > now:
+                    continue
+                if peer['last_seen'] is None or now - peer['last_seen'] > PING_INTERVAL:
+                    peer['ping_at'] = now
+                    res.append(address)
+        return res
+
+    def score(self, address) -> float:
+        '''
+        节点的健康分数，越大越好
+        '''
+        peer = self.peers.get(self.normalize(address))
+        if peer is None:
+            return 0.0
+        score = 1.0 / (1 + peer['failures'])
+        if peer['latency'] is not None:
+            score /= 1 + peer['latency']
+        return score
+
+    @staticmethod
+    def fanout(size: int) -> int:
+        '''
+        转发的节点数随网络规模按对数增长
+        '''
+        if size == 0:
+            return 0
+        return min(size, max(FANOUT_MIN, ceil(log2(size + 1)) + 1))
+
+    def sample(self, exclude=None) -> list:
+        '''
+        从可用节点中随机选择有限个用于转发，健康的节点被选中的概率更大
+        轻节点不参与转发
+        :param exclude: 不需要转发的节点（如消息的来源）
+        :return: 选中的节点
+        '''
+        light = set(self.light_peers())
+        candidates = [address for address in self.active() if address not in light]
+        if exclude is not None:
+            exclude = self.normalize(exclude)
+            candidates = [address for address in candidates if address != exclude]
+        weights = [self.score(address) for address in candidates]
+        candidates = [address for address, weight in zip(candidates, weights) if weight > 0]
+        weights = [weight for weight in weights if weight > 0]
+        k = self.fanout(len(candidates))
+        chosen = []
+        while len(chosen) < k:
+            i = random.choices(range(len(candidates)), weights=weights)[0]
+            chosen.append(candidates.pop(i))
+            weights.pop(i)
+        return chosen
+
+    def first_seen(self, msg_id: str) -> bool:
+        '''
+        记录消息 id，只有第一次见到的消息才需要处理和转发
+        '''
+        with self.lock:
+            if msg_id in self.seen:
+                return False
+            self.seen[msg_id] = True
+            if len(self.seen) > SEEN_SIZE:
+                self.seen.popitem(last=False)
+            return True
+
+    def show(self):
+        now = time()
+        with self.lock:
+            for address, peer in self.peers.items():
+                latency = '-' if peer['latency'] is None else '%.3fs' % peer['latency']
+                last_seen = '-' if peer['last_seen'] is None else '%.0fs ago' % (now - peer['last_seen'])
+                print(address, 'latency', latency, 'failures', peer['failures'], 'last seen', last_seen)
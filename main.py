@@ -1,12 +1,25 @@
+import zlib
 from threading import Thread
 from lib.network import *
 from lib.account import *
 from lib.chain import *
+from lib.light import *
 
 print('Working on', HOST, ":", PORT)
 
-BC = BlockChain()
+# 轻节点只同步 header 和钱包相关的 tx
+LIGHT = input('Light client (y/N):') == 'y'
+# 裁剪模式只保留最近若干个块的完整内容
+PRUNE_DEPTH = '' if LIGHT else input('Prune depth (empty for a full node):')
+BC = BlockChain(int(PRUNE_DEPTH) if PRUNE_DEPTH.isdigit() else None)
+LC = LightChain()
 CURRENT = None
+# 每个报文携带的 proof 数量
+PROOF_PAGE = 32
+# 交易历史每页的最大数量
+HISTORY_PAGE_MAX = 100
+# 每个报文携带的 header 数量，约 290 个 header 就会超过 UDP 报文的长度
+HEADER_PAGE = 200
 
 
 class ListenThread(Thread):
@@ -26,19 +39,57 @@ class ListenThread(Thread):
                 except ConnectionResetError:
                     continue
 
-                buffer = buffer.decode('utf-8')
-                if buffer == '':
+                if buffer == b'':
                     continue
-                msg = json.loads(buffer)
+                # 报文可能被压缩，逐行解析，第一行为报文头
+                objects = iter_objects(buffer)
+                try:
+                    msg = next(objects)
+                except (zlib.error, ValueError, StopIteration) as e:
+                    print("cannot decode message from", address, e)
+                    continue
+                if not isinstance(msg, dict) or 'type' not in msg or 'content' not in msg:
+                    print("invalid message from", address)
+                    continue
+                PEERS.seen_from(address)
 
                 content = msg['content']
-                if msg['type'] == 'broadcast_tx':
-                    BC.receive_tx(content)
+                if msg['type'] in ('ping', 'pong') and not valid_ping(content):
+                    print("invalid", msg['type'], "from", address)
+                    continue
+                if msg['type'] in ('broadcast_block', 'broadcast_header') and not isinstance(msg.get('index'), int):
+                    print("invalid block message from", address)
+                    continue
+                if msg['type'] in ('broadcast_tx', 'broadcast_block'):
+                    # 只处理第一次见到的消息，验证通过后才转发
+                    raw = json.dumps(msg, sort_keys=True)
+                    if not first_seen(raw):
+                        continue
+                if msg['type'] == 'ping':
+                    PEERS.set_codecs(address, content.get('codecs', []))
+                    PEERS.set_light(address, content.get('light', False))
+                    reply = {"type": "pong",
+                             "content": {"time": content['time'], "codecs": CODECS, "light": LIGHT},
+                             }
+                    send_msg(json.dumps(reply, sort_keys=True), address)
+                elif msg['type'] == 'pong':
+                    PEERS.pong(address, content['time'], content.get('codecs', []), content.get('light', False))
+                elif msg['type'] == 'broadcast_tx' and not LIGHT:
+                    if BC.receive_tx(content):
+                        relay(raw, address)
+                elif msg['type'] == 'broadcast_header' and LIGHT:
+                    receive_header(address, msg['index'], content)
+                elif msg['type'] == 'broadcast_block' and LIGHT:
+                    # 对方还不知道本节点是轻节点时仍会发来整个块，只取 header，不转发
+                    if isinstance(content, dict):
+                        receive_header(address, msg['index'], content.get('header'))
                 elif msg['type'] == 'broadcast_block':
                     # check the index
                     if msg['index'] == len(BC.chain):
                         # got a chance to be verified and accepted
-                        BC.receive_block(content)
+                        if BC.receive_block(content):
+                            relay(raw, address)
+                            announce_header(msg['index'], content['header'])
                     elif msg['index'] < len(BC.chain):
                         # warn that the other chain is too short
                         response_chain(address, msg['index'])
@@ -48,13 +99,36 @@ class ListenThread(Thread):
                 elif msg['type'] == 'request_chain':
                     response_chain(address, content)
                 elif msg['type'] == 'response_chain':
-                    BC.resolve_conflicts(content)
+                    # 剩余的行是链上的块，边解压边验证
+                    BC.resolve_conflicts(objects, content)
+                elif msg['type'] == 'refuse_chain':
+                    print(address, "cannot send its chain of", content, "blocks")
+                elif msg['type'] == 'request_history':
+                    response_history(address, content)
+                elif msg['type'] == 'response_history':
+                    print(json.dumps(content, indent=2, sort_keys=True))
+                elif msg['type'] == 'request_headers':
+                    response_headers(address, content)
+                elif msg['type'] == 'response_headers' and LIGHT:
+                    receive_headers(address, content, objects)
+                elif msg['type'] == 'request_proofs':
+                    response_proofs(address, content)
+                elif msg['type'] == 'response_proofs' and LIGHT:
+                    if not isinstance(content, int):
+                        print("invalid proofs response")
+                        continue
+                    try:
+                        for proof in objects:
+                            LC.receive_proof(proof)
+                    except (zlib.error, ValueError) as e:
+                        print("cannot decode proofs from", address, e)
 
         sub_thread = Thread(target=receive, args=())
         sub_thread.setDaemon(True)
         sub_thread.start()
         while not self.stopped:
             sub_thread.join(self.timeout)
+            ping_peers(LIGHT)
 
     def stop(self):
         self.stopped = True
@@ -71,21 +145,173 @@ def request_chain():
 
 
 def response_chain(address, chain_len):
+    '''
+    报文头之后每个块单独一行，接收方可以逐块解析和验证
+    :param address: 请求方
+    :param chain_len: 请求方的链长度
+    :return: None
+    '''
     if len(BC.chain) <= chain_len:
         return
+    if BC.pruned_height != 0:
+        # 裁剪后的块无法通过对方的验证
+        print("pruned node cannot serve the chain")
+        return
     msg = {"type": "response_chain",
-           "content": BC.chain,
+           "content": len(BC.chain),
+           }
+    if send_msg(encode_lines([msg] + BC.chain), address) is False:
+        # 链太长，无法放进一个报文
+        msg = {"type": "refuse_chain",
+               "content": len(BC.chain),
+               }
+        send_msg(json.dumps(msg, sort_keys=True), address)
+
+
+def response_history(address, query):
+    '''
+    回复某个地址的一页交易历史
+    :param address: 请求方
+    :param query: {"address": 地址, "page": 页码, "size": 每页数量}
+    :return: None
+    '''
+    if not isinstance(query, dict) or 'address' not in query:
+        print("invalid history request")
+        return
+    page = query.get('page', 0)
+    size = query.get('size', 10)
+    if not isinstance(page, int) or not isinstance(size, int):
+        print("invalid history request")
+        return
+    # 每页的数量有上限，避免超过 UDP 报文的长度
+    size = min(size, HISTORY_PAGE_MAX)
+    msg = {"type": "response_history",
+           "content": {"address": query['address'],
+                       "page": page,
+                       "history": BC.get_history(query['address'], page, size),
+                       },
            }
     send_msg(json.dumps(msg, sort_keys=True), address)
 
 
+def request_headers(address=None, start=None):
+    '''
+    :param address: 向某个节点请求下一页，为空时向所有节点请求
+    :param start: 起始的块高度，为空时从 LC.lookback() 开始
+    :return: None
+    '''
+    msg = {"type": "request_headers",
+           "content": LC.lookback() if start is None else start,
+           }
+    if address is None:
+        broadcast(json.dumps(msg, sort_keys=True))
+    else:
+        send_msg(json.dumps(msg, sort_keys=True), address)
+
+
+def response_headers(address, start):
+    '''
+    报文头之后每个 header 单独一行，被裁剪的块也保留了 header
+    每个报文最多 HEADER_PAGE 个，请求方根据 length 继续请求下一页
+    :param address: 请求方
+    :param start: 起始的块高度
+    :return: None
+    '''
+    if not isinstance(start, int) or start < 0:
+        print("invalid headers request")
+        return
+    if len(BC.chain) <= start:
+        return
+    msg = {"type": "response_headers",
+           "content": {"start": start, "length": len(BC.chain)},
+           }
+    headers = [block['header'] for block in BC.chain[start:start + HEADER_PAGE]]
+    send_msg(encode_lines([msg] + headers), address)
+
+
+def receive_header(address, index, header):
+    '''
+    轻节点收到新块的 header，不连续时向发送方请求缺少的 header
+    :param address: 发送方
+    :param index: 块的高度
+    :param header: 块的 header
+    :return: None
+    '''
+    if LC.receive_headers(index, [header]):
+        request_proofs()
+    elif index > len(LC.headers):
+        request_headers(address)
+
+
+def receive_headers(address, content, headers):
+    '''
+    验证收到的一页 header，对方的链还有剩余时继续向它请求下一页，全部收到后请求 proof
+    :param address: 发送方
+    :param content: {"start": 第一个 header 的高度, "length": 对方的链长度}
+    :param headers: header 的迭代器
+    :return: None
+    '''
+    if not isinstance(content, dict) or not isinstance(content.get('start'), int) \
+            or not isinstance(content.get('length'), int):
+        print("invalid headers response")
+        return
+    if not LC.receive_headers(content['start'], headers):
+        return
+    if len(LC.headers) < content['length']:
+        request_headers(address, len(LC.headers))
+    else:
+        request_proofs()
+
+
+def request_proofs():
+    if CURRENT is None:
+        return
+    msg = {"type": "request_proofs",
+           "content": {"address": CURRENT.get_address(), "start": LC.proof_start()},
+           }
+    broadcast(json.dumps(msg, sort_keys=True))
+
+
+def response_proofs(address, query):
+    '''
+    回复某个地址的 tx 及其 merkle 路径，每个一行
+    每个报文最多 PROOF_PAGE 个，避免超过 UDP 报文的长度
+    :param address: 请求方
+    :param query: {"address": 地址, "start": 起始的块高度}
+    :return: None
+    '''
+    if not isinstance(query, dict) or not isinstance(query.get('address'), str):
+        print("invalid proofs request")
+        return
+    start = query.get('start', 0)
+    if not isinstance(start, int) or start < 0:
+        print("invalid proofs request")
+        return
+    proofs = BC.get_proofs(query['address'], start)
+    for i in range(0, len(proofs), PROOF_PAGE):
+        page = proofs[i:i + PROOF_PAGE]
+        msg = {"type": "response_proofs",
+               "content": len(page),
+               }
+        send_msg(encode_lines([msg] + page), address)
+
+
+def wallet_utxo():
+    '''
+    当前账户的 utxo，全节点使用按收款方的索引，轻节点根据已验证的 tx 计算
+    '''
+    if LIGHT:
+        return LC.utxo(CURRENT.get_address())
+    return BC.utxo_of(CURRENT.get_address())
+
+
 def transaction():
     if CURRENT is None:
         print("No account available")
         return
     destin = input("input the payee's address:")
     amount = input("input the amount:")
-    new_tx = CURRENT.transfer(destin, int(amount), BC.utxo)
+    new_tx = CURRENT.transfer(destin, int(amount), wallet_utxo())
     if new_tx is None:
         print("transaction failed")
         return
@@ -96,14 +322,15 @@ def transaction():
     msg = {"type": "broadcast_tx",
            "content": new_tx,
            }
-    broadcast(json.dumps(msg, sort_keys=True))
+    gossip(json.dumps(msg, sort_keys=True))
 
 
 def account():
     global CURRENT
     account_help_info = '1 View Current Account\n' \
                         '2 View Balance\n' \
-                        '3 Create New Account'
+                        '3 Create New Account\n' \
+                        '4 Consolidate Outputs'
 
     while True:
         print(account_help_info)
@@ -116,7 +343,7 @@ def account():
                 print("No account now")
         elif opt == '2':
             if CURRENT is not None:
-                CURRENT.show_balance(BC.utxo)
+                CURRENT.show_balance(wallet_utxo())
                 break
             else:
                 print("No account now")
@@ -125,10 +352,32 @@ def account():
             CURRENT = Account(name)
             CURRENT.show_info()
             break
+        elif opt == '4':
+            if CURRENT is not None:
+                consolidate()
+                break
+            else:
+                print("No account now")
         else:
             print("Out of Range")
 
 
+def consolidate():
+    '''
+    空闲时合并当前账户零碎的未花费记录
+    :return: None
+    '''
+    new_tx = CURRENT.consolidate(wallet_utxo())
+    if new_tx is None:
+        print("nothing to consolidate")
+        return
+    BC.current_transactions.append(new_tx)
+    msg = {"type": "broadcast_tx",
+           "content": new_tx,
+           }
+    gossip(json.dumps(msg, sort_keys=True))
+
+
 def mine():
     '''
     实际上就是产生新块的过程
@@ -138,18 +387,22 @@ def mine():
     if CURRENT is None:
         print("No account available")
         return
+    if LIGHT:
+        print("light client cannot mine")
+        return
     new_block = BC.new_block(CURRENT)
     if new_block is None:
         print("mining failed")
         return
-    # 广播消息
+    # 广播消息，轻节点只收到 header
     msg = {"type": "broadcast_block",
            "index": len(BC.chain) - 1,
            "content": new_block,
            }
-    broadcast(json.dumps(msg, sort_keys=True))
+    gossip(json.dumps(msg, sort_keys=True))
+    announce_header(len(BC.chain) - 1, new_block['header'])
     # 显示挖矿后的余额
-    CURRENT.show_balance(BC.utxo)
+    CURRENT.show_balance(wallet_utxo())
 
 
 def debug():
@@ -157,12 +410,16 @@ def debug():
                       '2 View UTXO\n' \
                       '3 View Current Transactions\n' \
                       '4 Validate Current Chain\n' \
-                      '5 Exit Debug'
+                      '5 View Address History\n' \
+                      '6 Exit Debug'
     while True:
         print(debug_help_info)
         opt = input('>')
         if opt == '1':
-            BC.show_chain()
+            if LIGHT:
+                LC.show_headers()
+            else:
+                BC.show_chain()
         elif opt == '2':
             BC.show_utxo()
         elif opt == '3':
@@ -170,6 +427,10 @@ def debug():
         elif opt == '4':
             print(BC.valid_chain(BC.chain))
         elif opt == '5':
+            address = input("input the address:")
+            page = input("input the page:")
+            BC.show_history(address, int(page) if page.isdigit() else 0)
+        elif opt == '6':
             break
         else:
             print("Out of Range")
@@ -193,7 +454,10 @@ while True:
     elif s == '4':
         nodes()
     elif s == '5':
-        request_chain()
+        if LIGHT:
+            request_headers()
+        else:
+            request_chain()
     elif s == 'D':
         debug()
         continue